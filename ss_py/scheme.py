@@ -1,29 +1,59 @@
-import sys
+import os
 import re
-from typing import List, Union, Dict, Any, Callable, Optional
+import sys
+import traceback
+import itertools
+import operator
+from typing import List, Union, Dict, Any, Callable, Optional, Tuple, Iterator, Iterable
 
 SchemeSymbol = str
 SchemeProc = Callable[..., Any]
-SchemeValue = Union[float, bool, SchemeProc]
-Expression = Union[float, bool, SchemeSymbol, List['Expression']]
+SchemeValue = Union[int, float, bool, SchemeProc]
+Expression = Union[int, float, bool, SchemeSymbol, List['Expression']]
+
+# Source of Env.version stamps. They are unique across all Envs, so an
+# inline cache filled from one global env never validates against another.
+_versions = itertools.count()
+
+# Stands in for an unbound name, since False is a legitimate value.
+_MISSING = object()
 
 class Env:
     def __init__(self, bindings: Dict[str, SchemeValue], parent: Optional['Env'] = None):
         self.bindings = bindings
         self.parent = parent
+        # Changes whenever `bindings` is assigned through this Env.
+        self.version = next(_versions)
+        # Whether the PRIMOPS names still have the bindings they started
+        # with, so code that inlined them can run as compiled.
+        self.primops_intact = True
 
     def find(self, var: SchemeSymbol) -> Dict[str, SchemeValue]:
-        if var in self.bindings:
-            return self.bindings
-        if self.parent:
-            return self.parent.find(var)
+        env: Optional[Env] = self
+        while env is not None:
+            if var in env.bindings:
+                return env.bindings
+            env = env.parent
+        raise NameError(f"Variable '{var}' not found")
+
+    def get(self, var: SchemeSymbol) -> SchemeValue:
+        """Return the value bound to `var`, with one dict lookup per Env."""
+        env: Optional[Env] = self
+        while env is not None:
+            value = env.bindings.get(var, _MISSING)
+            if value is not _MISSING:
+                return value
+            env = env.parent
         raise NameError(f"Variable '{var}' not found")
 
     def __setitem__(self, key: SchemeSymbol, value: SchemeValue) -> None:
         self.bindings[key] = value
+        self.version = next(_versions)
+        if key in PRIMOPS:
+            self.primops_intact = False
 
     def __getitem__(self, key: SchemeSymbol) -> SchemeValue:
-        return self.find(key)[key]
+        return self.get(key)
 
     def __contains__(self, key: SchemeSymbol) -> bool:
         try:
@@ -32,58 +62,252 @@ class Env:
         except NameError:
             return False
 
-def tokenize(s: str) -> List[str]:
-    return re.sub(r'([()])', r' \1 ', s).split()
-
-def parse(tokens: List[str]) -> 'Expression':
-    if not tokens:
-        raise SyntaxError("Unexpected EOF while parsing")
-    
-    token = tokens.pop(0)
-    if token == '(':
-        L: List['Expression'] = []
-        while tokens and tokens[0] != ')':
-            L.append(parse(tokens))
-        
-        if not tokens or tokens[0] != ')':
-            raise SyntaxError("Expected ')'")
-        tokens.pop(0)
-        return L
-    
-    if token == ')':
-        raise SyntaxError("Unexpected ')'")
-    
-    return atom(token)
-
-
-def atom(token: str) -> Union[float, bool, SchemeSymbol]:
+# A paren or a run of anything up to the next paren, whitespace or ';'
+# (group 1), or a comment running to the end of the line (no group).
+_TOKEN_RE = re.compile(r'([()]|[^ \t\n\r\f\v();]+)|;[^\n]*')
+
+def tokenize(s: str) -> Iterator[str]:
+    """Lazily scan `s` into tokens, dropping comments."""
+    for match in _TOKEN_RE.finditer(s):
+        token = match.group(1)
+        if token is not None:
+            yield token
+
+def read(tokens: Iterable[str]) -> Iterator[Union['Expression', SyntaxError]]:
+    """Read expressions from `tokens` one at a time, without recursing.
+
+    A malformed expression is yielded as its SyntaxError, and reading
+    carries on after it.
+    """
+    # Lists still waiting for their ')', innermost last.
+    stack: List[List['Expression']] = []
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+            continue
+        if token == ')':
+            if not stack:
+                yield SyntaxError("Unexpected ')'")
+                continue
+            expr: 'Expression' = stack.pop()
+        else:
+            expr = atom(token)
+        if stack:
+            stack[-1].append(expr)
+        else:
+            yield expr
+
+    if stack:
+        yield SyntaxError("Expected ')'")
+
+def parse(tokens: Iterable[str]) -> 'Expression':
+    """Read the first expression from `tokens`."""
+    for expr in read(tokens):
+        if isinstance(expr, SyntaxError):
+            raise expr
+        return expr
+    raise SyntaxError("Unexpected EOF while parsing")
+
+
+def atom(token: str) -> Union[int, float, bool, SchemeSymbol]:
+    if token == '#t':
+        return True
+    if token == '#f':
+        return False
+    try:
+        return int(token)
+    except ValueError:
+        pass
     try:
         return float(token)
     except ValueError:
-        if token == '#t':
-            return True
-        if token == '#f':
-            return False
         return token
 
-def _define(expr: List[Expression], env: Env) -> None:
+# Opcodes. Every instruction is an (op, arg) tuple; arg indexes into the
+# owning Code's consts/names tables, or is a jump target, argument count,
+# frame slot or (depth, slot) pair.
+LOAD_CONST = 0
+LOAD_GLOBAL = 1
+DEFINE = 2
+JUMP = 3
+JUMP_IF_FALSE = 4
+JUMP_IF_FALSE_OR_POP = 5
+JUMP_IF_TRUE_OR_POP = 6
+MAKE_CLOSURE = 7
+CALL = 8
+TAIL_CALL = 9
+RETURN = 10
+LOAD_FAST = 11
+LOAD_LOCAL = 12
+ADD = 13
+SUB = 14
+MUL = 15
+DIV = 16
+EQ = 17
+LT = 18
+LE = 19
+GT = 20
+GE = 21
+NOT = 22
+# Placeholder for instructions removed by the peephole pass; never executed.
+NOP = 23
+# A top-level lambda calling the global it was defined as, in tail
+# position. If that global still holds a closure over this code, the
+# arguments are stored into the current frame and the body restarts at
+# pc 0; otherwise execution falls through to the TAIL_CALL that follows.
+SELF_TAIL_CALL = 24
+
+# Calls to these globals with the given arity compile to a single opcode
+# instead of a CALL. The lambdas in create_global_env() remain for
+# first-class uses such as passing `+` as an argument. Once a program
+# rebinds one of these names, code that inlined them is recompiled with
+# plain calls the next time it is entered (an activation already running
+# carries on as compiled), and code compiled after the define does not
+# inline them at all.
+PRIMOPS: Dict[SchemeSymbol, Tuple[int, int]] = {
+    '+': (ADD, 2),
+    '-': (SUB, 2),
+    '*': (MUL, 2),
+    '/': (DIV, 2),
+    '=': (EQ, 2),
+    '<': (LT, 2),
+    '<=': (LE, 2),
+    '>': (GT, 2),
+    '>=': (GE, 2),
+    'not': (NOT, 1),
+}
+_PRIMOP_OPS = {op for op, _ in PRIMOPS.values()}
+
+Instruction = Tuple[int, Any]
+# A procedure's arguments by slot, followed by the frame of the lambda it
+# was created in (None at top level) if the procedure is not closed.
+Frame = List[Any]
+
+class Code:
+    __slots__ = ('ops', 'consts', 'names', 'caches', 'params', 'nparams', 'scopes', 'outer', 'free',
+                 'defined_as', 'inline', 'source', 'generic', 'jit')
+
+    def __init__(self, scopes: List[List[SchemeSymbol]], outer: Optional['Code'] = None):
+        self.ops: List[Instruction] = []
+        self.consts: List[Any] = []
+        self.names: List[SchemeSymbol] = []
+        # Inline caches for LOAD_GLOBAL, parallel to `names`: the
+        # (Env.version, value) seen by the last lookup of each name.
+        self.caches: List[Tuple[int, Any]] = []
+        # Parameter lists of the enclosing lambdas, innermost last.
+        self.scopes = scopes
+        self.params = scopes[-1] if scopes else []
+        self.nparams = len(self.params)
+        # The Code of the enclosing lambda, while compiling.
+        self.outer = outer
+        # Whether running this code reads an enclosing lambda's frame. Only
+        # then do its frames link to the parent frame; closed procedures
+        # neither build the link nor keep the defining frame alive.
+        self.free = False
+        # Global name a lambda was defined under, used to spot self-calls.
+        self.defined_as: Optional[SchemeSymbol] = None
+        # Whether calls to PRIMOPS names may compile to their opcodes.
+        self.inline = True
+        # The expression compiled, kept only if PRIMOPS were inlined, and
+        # its recompilation without them once one has been rebound.
+        self.source: Optional[Expression] = None
+        self.generic: Optional[Code] = None
+        # None until first called; then False once the JIT has given up on
+        # it, or its JitPrograms by argument types.
+        self.jit: Union[None, bool, Dict[Tuple[str, ...], 'JitProgram']] = None
+
+    def emit(self, op: int, arg: Any = 0) -> int:
+        self.ops.append((op, arg))
+        return len(self.ops) - 1
+
+    def patch(self, index: int) -> None:
+        """Point the jump at `index` to the next instruction."""
+        self.ops[index] = (self.ops[index][0], len(self.ops))
+
+    def const(self, value: Any) -> int:
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def name(self, symbol: SchemeSymbol) -> int:
+        if symbol not in self.names:
+            self.names.append(symbol)
+            self.caches.append((-1, None))
+        return self.names.index(symbol)
+
+    def resolve(self, symbol: SchemeSymbol) -> Optional[Tuple[int, int]]:
+        """Return the (depth, slot) of a lambda parameter, or None for globals."""
+        for depth, params in enumerate(reversed(self.scopes)):
+            if symbol in params:
+                return depth, params.index(symbol)
+        return None
+
+    def capture(self, depth: int) -> None:
+        """Note a read `depth` frames out, which needs that many parent links."""
+        code: Optional[Code] = self
+        for _ in range(depth):
+            if code is None:
+                # Recompiling a lambda on its own; the enclosing code was
+                # marked when the lambda was first compiled.
+                break
+            code.free = True
+            code = code.outer
+
+    def deoptimized(self) -> 'Code':
+        """This code compiled with plain calls in place of PRIMOPS opcodes."""
+        if self.source is None:
+            return self
+        if self.generic is None:
+            self.generic = compile_expr(self.source, self.scopes, self.defined_as, inline=False)
+        return self.generic
+
+class Closure:
+    __slots__ = ('code', 'frame', 'env')
+
+    def __init__(self, code: Code, frame: Optional[Frame], env: Env):
+        self.code = code
+        self.frame = frame
+        self.env = env
+
+    def __call__(self, *args: SchemeValue) -> SchemeValue:
+        return run(self.code, self.env, _bind(self.code, list(args), self.frame))
+
+def _bind(code: Code, args: List[SchemeValue], parent: Optional[Frame]) -> Frame:
+    if len(args) != code.nparams:
+        raise TypeError(f"Expected {code.nparams} arguments, got {len(args)}")
+    if code.free:
+        args.append(parent)
+    return args
+
+def _define(expr: List[Expression], code: Code, tail: bool) -> None:
     if len(expr) != 3 or not isinstance(expr[1], str):
         raise SyntaxError("Malformed define expression")
     _, var, value = expr
     if not isinstance(var, SchemeSymbol):
         raise SyntaxError("First argument to define must be a symbol")
-    env[var] = evaluate(value, env)
-    return None
+    if var in PRIMOPS:
+        outer: Optional[Code] = code
+        while outer is not None:
+            outer.inline = False
+            outer = outer.outer
+    if isinstance(value, list) and value and value[0] == 'lambda':
+        _lambda(value, code, False, var)
+    else:
+        _compile(value, code, False)
+    code.emit(DEFINE, code.name(var))
 
-def _if(expr: List[Expression], env: Env) -> SchemeValue:
+def _if(expr: List[Expression], code: Code, tail: bool) -> None:
     if len(expr) != 4:
         raise SyntaxError("Malformed if expression")
     _, test, consequent, alternative = expr
-    if evaluate(test, env) is not False:
-        return evaluate(consequent, env)
-    return evaluate(alternative, env)
+    _compile(test, code, False)
+    to_alternative = code.emit(JUMP_IF_FALSE)
+    _compile(consequent, code, tail)
+    to_end = code.emit(JUMP)
+    code.patch(to_alternative)
+    _compile(alternative, code, tail)
+    code.patch(to_end)
 
-def _lambda(expr: List[Expression], env: Env) -> SchemeProc:
+def _lambda(expr: List[Expression], code: Code, tail: bool, defined_as: Optional[SchemeSymbol] = None) -> None:
     if len(expr) != 3 or not isinstance(expr[1], list) or not all(isinstance(p, str) for p in expr[1]):
         raise SyntaxError("Malformed lambda expression")
     _, params, body = expr
@@ -91,58 +315,679 @@ def _lambda(expr: List[Expression], env: Env) -> SchemeProc:
         raise SyntaxError("Lambda parameters must be a list")
     if not all(isinstance(p, SchemeSymbol) for p in params):
         raise SyntaxError("Lambda parameters must be symbols")
-    return lambda *args: evaluate(body, Env(dict(zip(params, args)), env)) #type: ignore
+    code.emit(MAKE_CLOSURE, code.const(_compile_code(body, code.scopes + [params], code, defined_as, code.inline))) #type: ignore
 
-def _and(expr: List[Expression], env: Env) -> bool:
+def _and(expr: List[Expression], code: Code, tail: bool) -> None:
     if len(expr) == 1:
-        return True 
-    
-    val: Any = True
-    for arg in expr[1:]:
-        val = evaluate(arg, env)
-        if val is False:
-            return False
-    return val
+        code.emit(LOAD_CONST, code.const(True))
+        return
+
+    jumps = []
+    for arg in expr[1:-1]:
+        _compile(arg, code, False)
+        jumps.append(code.emit(JUMP_IF_FALSE_OR_POP))
+    _compile(expr[-1], code, tail)
+    for jump in jumps:
+        code.patch(jump)
 
-def _or(expr: List[Any], env: Env) -> bool:
+def _or(expr: List[Any], code: Code, tail: bool) -> None:
     if len(expr) == 1:
-        return False
-        
-    val: Any = False
-    for arg in expr[1:]:
-        val = evaluate(arg, env)
-        if val is not False:
-            return val
-    return val
+        code.emit(LOAD_CONST, code.const(False))
+        return
+
+    jumps = []
+    for arg in expr[1:-1]:
+        _compile(arg, code, False)
+        jumps.append(code.emit(JUMP_IF_TRUE_OR_POP))
+    _compile(expr[-1], code, tail)
+    for jump in jumps:
+        code.patch(jump)
 
-special_forms: Dict[str, Callable[[List[Expression], Env], SchemeValue]] = {
+special_forms: Dict[str, Callable[[List[Expression], Code, bool], None]] = {
+    'define': _define,
     'if': _if,
     'lambda': _lambda,
     'and': _and,
     'or': _or,
 }
 
-def evaluate(expr: Expression, env: Env) -> SchemeValue:    
-    if isinstance(expr, (float, bool)):
-        return expr
-    if isinstance(expr, str):
-        return env.find(expr)[expr]
-    
+def _compile(expr: Expression, code: Code, tail: bool) -> None:
+    t = type(expr)
+    if t is int or t is float or t is bool:
+        code.emit(LOAD_CONST, code.const(expr))
+        return
+    if t is str:
+        location = code.resolve(expr)
+        if location is None:
+            code.emit(LOAD_GLOBAL, code.name(expr))
+        elif location[0] == 0:
+            code.emit(LOAD_FAST, location[1])
+        else:
+            code.emit(LOAD_LOCAL, location)
+            code.capture(location[0])
+        return
+
     if not isinstance(expr, list) or not expr:
         raise SyntaxError(f"Malformed expression: {expr}")
 
     form = expr[0]
+    if type(form) is str:
+        handler = special_forms.get(form)
+        if handler is not None:
+            handler(expr, code, tail)
+            return
+        primop = PRIMOPS.get(form)
+        if primop is not None and code.inline and primop[1] == len(expr) - 1 and code.resolve(form) is None:
+            for arg in expr[1:]:
+                _compile(arg, code, False)
+            code.emit(primop[0])
+            return
 
-    if isinstance(form, str) and form == 'define':
-         return _define(expr, env)  # type: ignore
-    if isinstance(form, str) and form in special_forms:
-         return special_forms[form](expr, env)
-    else:
-        proc = evaluate(form, env)
-        if not callable(proc):
-            raise TypeError(f"Procedure is not callable: {form}")
-        args = [evaluate(arg, env) for arg in expr[1:]]
-        return proc(*args)
+    _compile(form, code, False)
+    for arg in expr[1:]:
+        _compile(arg, code, False)
+    if (tail and form == code.defined_as and len(code.scopes) == 1 and code.resolve(form) is None
+            and len(expr) - 1 == code.nparams):
+        code.emit(SELF_TAIL_CALL, len(expr) - 1)
+    code.emit(TAIL_CALL if tail else CALL, len(expr) - 1)
+
+# The compiler recurses about twice per nesting level (four times per
+# nested lambda), so it runs under a raised recursion limit; read() and
+# run() do not recurse at all.
+COMPILE_RECURSION_LIMIT = 20000
+
+def compile_expr(expr: Expression, scopes: Optional[List[List[SchemeSymbol]]] = None,
+                 defined_as: Optional[SchemeSymbol] = None, inline: bool = True) -> Code:
+    """Compile a top-level form, or the body of a lambda inside `scopes`."""
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, COMPILE_RECURSION_LIMIT))
+    try:
+        return _compile_code(expr, scopes or [], None, defined_as, inline)
+    finally:
+        sys.setrecursionlimit(limit)
+
+def _compile_code(expr: Expression, scopes: List[List[SchemeSymbol]], outer: Optional[Code],
+                  defined_as: Optional[SchemeSymbol], inline: bool) -> Code:
+    code = Code(scopes, outer)
+    code.defined_as = defined_as
+    code.inline = inline
+    _compile(expr, code, True)
+    code.emit(RETURN)
+    if any(op in _PRIMOP_OPS for op, _ in code.ops):
+        # Also covers what peephole() folds, which only folds these.
+        code.source = expr
+    if any(isinstance(const, Code) and const.free for const in code.consts):
+        # Closures made here keep the current frame; it must not be reused.
+        code.ops = [(NOP, 0) if op == SELF_TAIL_CALL else (op, arg) for op, arg in code.ops]
+    peephole(code)
+    code.outer = None
+    return code
+
+PEEPHOLE_PASSES = 8
+
+_JUMPS = (JUMP, JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP)
+
+_FOLDABLE: Dict[int, Callable[[Any, Any], Any]] = {
+    ADD: operator.add,
+    SUB: operator.sub,
+    MUL: operator.mul,
+    DIV: operator.truediv,
+    EQ: operator.eq,
+    LT: operator.lt,
+    LE: operator.le,
+    GT: operator.gt,
+    GE: operator.ge,
+}
+
+def peephole(code: Code) -> None:
+    """Simplify `code.ops` in place until nothing changes (or PEEPHOLE_PASSES)."""
+    for _ in range(PEEPHOLE_PASSES):
+        if not _peephole_pass(code):
+            break
+
+def _reachable(ops: List[Instruction]) -> List[bool]:
+    live = [False] * len(ops)
+    todo = [0]
+    while todo:
+        pc = todo.pop()
+        if pc >= len(ops) or live[pc]:
+            continue
+        live[pc] = True
+        op, arg = ops[pc]
+        if op in _JUMPS:
+            todo.append(arg)
+        if op != JUMP and op != RETURN:
+            todo.append(pc + 1)
+    return live
+
+def _peephole_pass(code: Code) -> bool:
+    ops = code.ops
+    changed = any(op == NOP for op, _ in ops)
+    live = _reachable(ops)
+    for pc, alive in enumerate(live):
+        if not alive:
+            ops[pc] = (NOP, 0)
+            changed = True
+    targets = {arg for op, arg in ops if op in _JUMPS}
+
+    def folds(pc: int, length: int) -> bool:
+        """Whether ops[pc:pc + length] is a straight run nobody jumps into."""
+        return pc + length <= len(ops) and all(i not in targets for i in range(pc + 1, pc + length))
+
+    for pc, (op, arg) in enumerate(ops):
+        if op == LOAD_CONST and folds(pc, 3) and ops[pc + 1][0] == LOAD_CONST and ops[pc + 2][0] in _FOLDABLE:
+            a, b = code.consts[arg], code.consts[ops[pc + 1][1]]
+            fold = ops[pc + 2][0]
+            if fold == DIV and b == 0:
+                continue  # leave the error to run time
+            ops[pc] = (LOAD_CONST, code.const(_FOLDABLE[fold](a, b)))
+            ops[pc + 1] = ops[pc + 2] = (NOP, 0)
+            changed = True
+        elif op == LOAD_CONST and folds(pc, 2) and ops[pc + 1][0] == NOT:
+            ops[pc] = (LOAD_CONST, code.const(not code.consts[arg]))
+            ops[pc + 1] = (NOP, 0)
+            changed = True
+        elif op == LOAD_CONST and folds(pc, 2) and ops[pc + 1][0] in _JUMPS and ops[pc + 1][0] != JUMP:
+            # A branch on a literal is either always or never taken.
+            test, target = ops[pc + 1]
+            truthy = code.consts[arg] is not False
+            taken = truthy if test == JUMP_IF_TRUE_OR_POP else not truthy
+            if not taken:
+                ops[pc] = ops[pc + 1] = (NOP, 0)
+            elif test == JUMP_IF_FALSE:
+                ops[pc], ops[pc + 1] = (NOP, 0), (JUMP, target)
+            else:
+                ops[pc + 1] = (JUMP, target)
+            changed = True
+        elif op == JUMP:
+            target = arg
+            while ops[target][0] == NOP:
+                target += 1
+            following = pc + 1
+            while following < len(ops) and ops[following][0] == NOP:
+                following += 1
+            if target == following:
+                ops[pc] = (NOP, 0)
+                changed = True
+            elif ops[target][0] == RETURN:
+                ops[pc] = (RETURN, 0)
+                changed = True
+            elif ops[target][0] == JUMP and ops[target][1] != target:
+                ops[pc] = (JUMP, ops[target][1])
+                changed = True
+
+    if changed:
+        # Drop the NOPs and renumber jump targets to match.
+        index = []
+        kept = 0
+        for op, _ in ops:
+            index.append(kept)
+            if op != NOP:
+                kept += 1
+        index.append(kept)
+        code.ops = [(op, index[arg] if op in _JUMPS else arg) for op, arg in ops if op != NOP]
+    return changed
+
+def run(code: Code, env: Env, frame: Optional[Frame] = None) -> SchemeValue:
+    """Execute `code` against the global `env`.
+
+    `frame` is the innermost lexical frame; a (depth, slot) operand is
+    found by following the parent link at the end of each frame `depth`
+    times.
+    """
+    intact = env.primops_intact
+    if not intact:
+        code = code.deoptimized()
+    ops, consts, names, caches = code.ops, code.consts, code.names, code.caches
+    stack: List[Any] = []
+    # Return addresses of the Scheme procedures currently being applied.
+    # Calls never recurse in Python, so only the heap bounds Scheme depth.
+    calls: List[Tuple[Code, int, Optional[Frame]]] = []
+    pc = 0
+    while True:
+        op, arg = ops[pc]
+        pc += 1
+        if op == LOAD_FAST:
+            stack.append(frame[arg])  # type: ignore
+        elif op == LOAD_CONST:
+            stack.append(consts[arg])
+        elif op == SUB:
+            b = stack.pop()
+            stack[-1] = stack[-1] - b
+        elif op == ADD:
+            b = stack.pop()
+            stack[-1] = stack[-1] + b
+        elif op == MUL:
+            b = stack.pop()
+            stack[-1] = stack[-1] * b
+        elif op == DIV:
+            b = stack.pop()
+            stack[-1] = stack[-1] / b
+        elif op == EQ:
+            b = stack.pop()
+            stack[-1] = stack[-1] == b
+        elif op == LT:
+            b = stack.pop()
+            stack[-1] = stack[-1] < b
+        elif op == LE:
+            b = stack.pop()
+            stack[-1] = stack[-1] <= b
+        elif op == GT:
+            b = stack.pop()
+            stack[-1] = stack[-1] > b
+        elif op == GE:
+            b = stack.pop()
+            stack[-1] = stack[-1] >= b
+        elif op == NOT:
+            stack[-1] = not stack[-1]
+        elif op == LOAD_GLOBAL:
+            version, value = caches[arg]
+            if version != env.version:
+                value = env.get(names[arg])
+                if env.parent is None:
+                    caches[arg] = (env.version, value)
+            stack.append(value)
+        elif op == LOAD_LOCAL:
+            depth, slot = arg
+            outer: Any = frame
+            while depth:
+                outer = outer[-1]
+                depth -= 1
+            stack.append(outer[slot])
+        elif op == CALL or op == TAIL_CALL:
+            if arg == 1:
+                args = [stack.pop()]
+            elif arg:
+                args = stack[-arg:]
+                del stack[-arg:]
+            else:
+                args = []
+            proc = stack.pop()
+            if type(proc) is Closure:
+                callee = proc.code
+                if not intact:
+                    callee = callee.deoptimized()
+                if arg != callee.nparams:
+                    raise TypeError(f"Expected {callee.nparams} arguments, got {arg}")
+                if callee.jit is not False:
+                    value = _jit_call(proc, callee, args, env)
+                    if value is not None:
+                        stack.append(value)
+                        continue
+                if callee.free:
+                    args.append(proc.frame)
+                if op == CALL:
+                    calls.append((code, pc, frame))
+                code = callee
+                ops, consts, names, caches = code.ops, code.consts, code.names, code.caches
+                frame = args
+                pc = 0
+            elif callable(proc):
+                stack.append(proc(*args))
+            else:
+                raise TypeError(f"Procedure is not callable: {proc}")
+        elif op == SELF_TAIL_CALL:
+            # Left to TAIL_CALL while the JIT is still counting calls.
+            proc = stack[-1 - arg]
+            if type(proc) is Closure and proc.code is code and code.jit is False:
+                if arg:
+                    frame[:arg] = stack[-arg:]  # type: ignore
+                del stack[-arg - 1:]
+                pc = 0
+        elif op == JUMP_IF_FALSE:
+            if stack.pop() is False:
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == RETURN:
+            if not calls:
+                return stack.pop()
+            code, pc, frame = calls.pop()
+            ops, consts, names, caches = code.ops, code.consts, code.names, code.caches
+        elif op == JUMP_IF_FALSE_OR_POP:
+            if stack[-1] is False:
+                pc = arg
+            else:
+                stack.pop()
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[-1] is not False:
+                pc = arg
+            else:
+                stack.pop()
+        elif op == MAKE_CLOSURE:
+            closure_code = consts[arg]
+            stack.append(Closure(closure_code, frame if closure_code.free else None, env))
+        elif op == DEFINE:
+            env[names[arg]] = stack.pop()
+            intact = env.primops_intact
+            stack.append(None)
+        else:
+            raise RuntimeError(f"Unknown opcode: {op}")
+
+# Numeric, self-recursive procedures (fib, factorial, counting loops) can
+# run in a Numba-compiled copy of the dispatch loop that keeps every value
+# as a float64. It is off unless SCHEME_JIT=1: importing Numba and loading
+# the compiled kernel costs ~0.4 s even from its on-disk cache (~1 s
+# cold), more than most programs run. When on, Numba is only imported once
+# some procedure has been called JIT_THRESHOLD times. It wins on long
+# numeric runs, e.g. tests/fib_bench.ss takes about 0.6 s instead of 1.2 s
+# (`SCHEME_JIT=1 python test_runner.py --bench`; see README.md).
+JIT_ENABLED = os.environ.get('SCHEME_JIT') == '1'
+JIT_THRESHOLD = 1000
+JIT_STACK_SIZE = 1 << 16
+JIT_CALL_DEPTH = 1 << 14
+# Integers are exact in a float64 below 2**53; a program doing integer
+# arithmetic leaves the kernel as soon as a result reaches that, since a
+# true result just past it rounds down to 2**53 itself.
+JIT_INT_LIMIT = 2 ** 53
+
+_NUMBER_TYPES = {int: 'int', float: 'float'}
+
+class JitProgram:
+    __slots__ = ('ops', 'consts', 'signature', 'room', 'result', 'limit', 'calls')
+
+    def __init__(self, ops: List[int], consts: List[float], signature: Tuple[str, ...],
+                 room: int, result: str, limit: float):
+        self.ops: Any = ops
+        self.consts: Any = consts
+        # 'int' or 'float' for each parameter.
+        self.signature = signature
+        # Most operand stack slots one activation needs.
+        self.room = room
+        # 'int', 'float' or 'bool': how to box the float64 the kernel returns.
+        self.result = result
+        # Magnitude an arithmetic result in the kernel must stay below.
+        self.limit = limit
+        self.calls = 0
+
+_JIT_OPS = {LOAD_FAST, LOAD_CONST, LOAD_GLOBAL, ADD, SUB, MUL, DIV, EQ, LT, LE, GT, GE, NOT,
+            JUMP, JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP,
+            CALL, TAIL_CALL, SELF_TAIL_CALL, RETURN}
+
+def _jit_candidate(code: Code) -> bool:
+    """Whether `code` uses only what the kernel supports, whatever the types."""
+    if code.defined_as is None:
+        return False
+    for op, arg in code.ops:
+        if op not in _JIT_OPS:
+            return False
+        if op == LOAD_CONST and type(code.consts[arg]) not in (int, float, bool):
+            return False
+        if op == LOAD_GLOBAL and code.names[arg] != code.defined_as:
+            return False
+    return True
+
+def _jit_translate(code: Code, signature: Tuple[str, ...]) -> Optional[JitProgram]:
+    for result in ('int', 'float', 'bool'):
+        program = _jit_typecheck(code, signature, result)
+        if program is not None:
+            return program
+    return None
+
+def _jit_typecheck(code: Code, signature: Tuple[str, ...], result: str) -> Optional[JitProgram]:
+    """Check that `code` only does arithmetic and calls itself.
+
+    Abstractly runs the bytecode over the types 'int', 'float', 'bool' and
+    'self', assuming the parameters have the types in `signature` and the
+    procedure returns `result`, so the kernel can represent every value as
+    a float64 and still box it back correctly. Returns None if anything
+    else shows up.
+    """
+    nparams = len(signature)
+    consts: List[float] = []
+    flat: List[int] = []
+    pending: Dict[int, Tuple[str, ...]] = {}
+    current: Optional[Tuple[str, ...]] = ()
+    room = 0
+    exact = False
+    for pc, (op, arg) in enumerate(code.ops):
+        if pc in pending:
+            if current is not None and current != pending[pc]:
+                return None
+            current = pending.pop(pc)
+        flat += (op, arg if isinstance(arg, int) else 0)
+        if current is None:
+            continue
+        room = max(room, len(current))
+        if op == LOAD_FAST:
+            current += (signature[arg],)
+        elif op == LOAD_CONST:
+            value = code.consts[arg]
+            if type(value) is bool:
+                current += ('bool',)
+            elif type(value) in _NUMBER_TYPES and abs(value) < JIT_INT_LIMIT:
+                current += (_NUMBER_TYPES[type(value)],)
+            else:
+                return None
+            flat[-1] = len(consts)
+            consts.append(float(value))
+        elif op == LOAD_GLOBAL:
+            if code.names[arg] != code.defined_as:
+                return None
+            current += ('self',)
+        elif op in (ADD, SUB, MUL, DIV, EQ, LT, LE, GT, GE):
+            a, b = current[-2:]
+            if a not in ('int', 'float') or b not in ('int', 'float'):
+                return None
+            if op in (EQ, LT, LE, GT, GE):
+                kind = 'bool'
+            elif op != DIV and a == b == 'int':
+                kind = 'int'
+                exact = True
+            else:
+                kind = 'float'
+            current = current[:-2] + (kind,)
+        elif op == NOT:
+            if current[-1:] != ('bool',):
+                return None
+        elif op == JUMP_IF_FALSE:
+            if current[-1:] != ('bool',):
+                return None
+            current = current[:-1]
+            if pending.setdefault(arg, current) != current:
+                return None
+        elif op == JUMP_IF_FALSE_OR_POP or op == JUMP_IF_TRUE_OR_POP:
+            if current[-1:] != ('bool',):
+                return None
+            if pending.setdefault(arg, current) != current:
+                return None
+            current = current[:-1]
+        elif op == JUMP:
+            if pending.setdefault(arg, current) != current:
+                return None
+            current = None
+        elif op == CALL or op == TAIL_CALL or op == SELF_TAIL_CALL:
+            if arg != nparams or current[-arg - 1:] != ('self',) + signature:
+                return None
+            if op == CALL:
+                current = current[:-arg - 1] + (result,)
+            elif op == TAIL_CALL:
+                current = None
+        elif op == RETURN:
+            if current != (result,):
+                return None
+            current = None
+        else:
+            return None
+    limit = float(JIT_INT_LIMIT) if exact else float('inf')
+    return JitProgram(flat, consts, signature, room + 1, result, limit)
+
+def _jit_call(proc: Closure, code: Code, args: List[SchemeValue], env: Env) -> Union[None, int, float, bool]:
+    """Run `proc`, as `code`, in the JIT kernel, or return None to use the interpreter."""
+    if code.jit is None:
+        code.jit = {} if JIT_ENABLED and _jit_candidate(code) else False
+    if code.jit is False:
+        return None
+    # Give up for good at the first call the kernel cannot take, so that
+    # the procedure stops paying for these checks (and SELF_TAIL_CALL can
+    # loop in the interpreter).
+    kinds = []
+    for value in args:
+        kind = _NUMBER_TYPES.get(type(value))
+        if kind is None or abs(value) >= JIT_INT_LIMIT:  # type: ignore
+            code.jit = False
+            return None
+        kinds.append(kind)
+    signature = tuple(kinds)
+    program = code.jit.get(signature)  # type: ignore
+    if program is None:
+        program = _jit_translate(code, signature)
+        if program is None:
+            code.jit = False
+            return None
+        code.jit[signature] = program  # type: ignore
+    # The kernel resolves every self-call to `proc` itself.
+    if env.bindings.get(code.defined_as) is not proc:  # type: ignore
+        return None
+    program.calls += 1
+    if program.calls < JIT_THRESHOLD:
+        return None
+    kernel = _jit_kernel()
+    if kernel is None:
+        code.jit = False
+        return None
+    if isinstance(program.ops, list):
+        program.ops = _np.array(program.ops, dtype=_np.int64)
+        program.consts = _np.array(program.consts, dtype=_np.float64)
+    stack, calls = _jit_buffers
+    stack[:len(args)] = args
+    status, value = kernel(program.ops, program.consts, len(args), program.room, program.limit, stack, calls)
+    if status != 0:
+        # Out of kernel stack, past the exact integer range, or a division
+        # by zero that the interpreter should report; the procedure is
+        # pure, so re-running it there is safe.
+        code.jit = False
+        return None
+    # The only boxing: values never leave the kernel's float64 stack
+    # until the outermost call returns.
+    if program.result == 'bool':
+        return value != 0.0
+    if program.result == 'int':
+        return int(value)
+    return float(value)
+
+_np: Any = None
+_jit_loop: Any = None
+_jit_buffers: Any = None
+
+def _jit_kernel() -> Any:
+    global _np, _jit_loop, _jit_buffers
+    if _jit_loop is None:
+        try:
+            import numba  # type: ignore
+            import numpy  # type: ignore
+        except ImportError:
+            _jit_loop = False
+            return None
+        _np = numpy
+        _jit_buffers = (numpy.empty(JIT_STACK_SIZE, dtype=numpy.float64),
+                        numpy.empty((JIT_CALL_DEPTH, 2), dtype=numpy.int64))
+        _jit_loop = numba.njit(cache=True)(_jit_run)
+    return _jit_loop or None
+
+def _jit_run(ops: Any, consts: Any, nparams: int, room: int, limit: float, stack: Any, calls: Any) -> Tuple[int, float]:
+    """The dispatch loop of run(), restricted to JitProgram bytecode.
+
+    `ops` holds (op, arg) pairs flattened, the arguments of the outermost
+    call are already in stack[:nparams], and each activation's parameters
+    sit at the bottom of its stack segment starting at `fp`. Returns
+    (0, value), or (1, 0.0) when the interpreter has to take over.
+    """
+    pc = 0
+    fp = 0
+    sp = nparams
+    depth = 0
+    while True:
+        op = ops[2 * pc]
+        arg = ops[2 * pc + 1]
+        pc += 1
+        if op == LOAD_FAST:
+            stack[sp] = stack[fp + arg]
+            sp += 1
+        elif op == LOAD_CONST:
+            stack[sp] = consts[arg]
+            sp += 1
+        elif op == SUB:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] - stack[sp]
+            if abs(stack[sp - 1]) >= limit:
+                return 1, 0.0
+        elif op == ADD:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] + stack[sp]
+            if abs(stack[sp - 1]) >= limit:
+                return 1, 0.0
+        elif op == MUL:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] * stack[sp]
+            if abs(stack[sp - 1]) >= limit:
+                return 1, 0.0
+        elif op == DIV:
+            sp -= 1
+            if stack[sp] == 0.0:
+                return 1, 0.0
+            stack[sp - 1] = stack[sp - 1] / stack[sp]
+        elif op == EQ:
+            sp -= 1
+            stack[sp - 1] = 1.0 if stack[sp - 1] == stack[sp] else 0.0
+        elif op == LT:
+            sp -= 1
+            stack[sp - 1] = 1.0 if stack[sp - 1] < stack[sp] else 0.0
+        elif op == LE:
+            sp -= 1
+            stack[sp - 1] = 1.0 if stack[sp - 1] <= stack[sp] else 0.0
+        elif op == GT:
+            sp -= 1
+            stack[sp - 1] = 1.0 if stack[sp - 1] > stack[sp] else 0.0
+        elif op == GE:
+            sp -= 1
+            stack[sp - 1] = 1.0 if stack[sp - 1] >= stack[sp] else 0.0
+        elif op == NOT:
+            stack[sp - 1] = 1.0 - stack[sp - 1]
+        elif op == JUMP_IF_FALSE:
+            sp -= 1
+            if stack[sp] == 0.0:
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == JUMP_IF_FALSE_OR_POP:
+            if stack[sp - 1] == 0.0:
+                pc = arg
+            else:
+                sp -= 1
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[sp - 1] != 0.0:
+                pc = arg
+            else:
+                sp -= 1
+        elif op == LOAD_GLOBAL:
+            # Always the procedure itself; CALL does not need it.
+            pass
+        elif op == CALL:
+            if depth == calls.shape[0] or sp + room >= stack.shape[0]:
+                return 1, 0.0
+            calls[depth, 0] = pc
+            calls[depth, 1] = fp
+            depth += 1
+            fp = sp - nparams
+            pc = 0
+        elif op == TAIL_CALL or op == SELF_TAIL_CALL:
+            for i in range(nparams):
+                stack[fp + i] = stack[sp - nparams + i]
+            sp = fp + nparams
+            pc = 0
+        elif op == RETURN:
+            value = stack[sp - 1]
+            if depth == 0:
+                return 0, value
+            sp = fp
+            stack[sp] = value
+            sp += 1
+            depth -= 1
+            pc = calls[depth, 0]
+            fp = calls[depth, 1]
+        else:
+            return 1, 0.0
 
 def create_global_env() -> Env:
     return Env({
@@ -173,36 +1018,76 @@ def sprint(value: SchemeValue) -> None:
 def main() -> None:
     global_env = create_global_env()
 
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve_mode()
+    elif len(sys.argv) > 1:
         file_mode(sys.argv[1], global_env)
     else:
         repl_mode(global_env)
 
+Program = List[Union[Code, SyntaxError]]
+
+def compile_program(text: str) -> Program:
+    program: Program = []
+    # One pass over the text: each form goes to the compiler as soon as
+    # its ')' is read, and its tree is only kept (as Code.source) by code
+    # that inlines PRIMOPS.
+    for expr in read(tokenize(text)):
+        if isinstance(expr, SyntaxError):
+            program.append(expr)
+            continue
+        try:
+            program.append(compile_expr(expr))
+        except SyntaxError as e:
+            program.append(e)
+        except RecursionError:
+            # Past what even COMPILE_RECURSION_LIMIT allows.
+            program.append(SyntaxError("Expression nested too deeply"))
+    return program
+
 def file_mode(filename: str, env: Env) -> None:
     try:
         with open(filename, 'r', encoding='utf-8') as f:
-            source_buffer = ""
-            for line in f:
-                stripped_line = line.strip()
-                if not stripped_line or stripped_line.startswith(';'):
-                    continue
-                source_buffer += " " + stripped_line
-
-                open_parens = source_buffer.count('(')
-                close_parens = source_buffer.count(')')
-
-                if (open_parens > 0 and open_parens == close_parens) or (open_parens == 0 and close_parens == 0 and not source_buffer.isspace()):
-                    try:
-                        result = evaluate(parse(tokenize(source_buffer)), env)
-                        if result is not None:
-                            sprint(result)
-                    except (SyntaxError, NameError, TypeError, IndexError) as e:
-                        print(f"Error: {e}")
-                    finally:
-                        source_buffer = ""
-
+            text = f.read()
     except FileNotFoundError:
         print(f"Error: File '{filename}' not found.")
+        return
+
+    for code in compile_program(text):
+        if isinstance(code, SyntaxError):
+            print(f"Error: {code}")
+            continue
+        try:
+            result = run(code, env)
+            if result is not None:
+                sprint(result)
+        except (NameError, TypeError, IndexError) as e:
+            print(f"Error: {e}")
+
+END_MARKER = '---END---'
+
+def serve_mode() -> None:
+    """Run each file named on stdin, ending its output with END_MARKER.
+
+    Lets a test runner pay for interpreter startup once for a whole suite.
+    Every file still gets a fresh global environment. After each file,
+    stdout gets "END_MARKER <status>", where status is what running it on
+    its own would have exited with, and stderr gets a bare END_MARKER line.
+    An error that would have ended the file's own process goes to stderr
+    without stopping the files after it.
+    """
+    for line in sys.stdin:
+        filename = line.strip()
+        if not filename:
+            continue
+        status = 0
+        try:
+            file_mode(filename, create_global_env())
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        print(END_MARKER, file=sys.stderr, flush=True)
+        print(f"{END_MARKER} {status}", flush=True)
 
 def repl_mode(env: Env) -> None:
     while True:
@@ -213,11 +1098,13 @@ def repl_mode(env: Env) -> None:
             if expr.strip() == "exit":
                 break
             
-            result = evaluate(parse(tokenize(expr)), env)
+            result = run(compile_expr(parse(tokenize(expr))), env)
             if result is not None:
                 sprint(result)
         except (SyntaxError, NameError, TypeError, IndexError) as e:
             print(f"Error: {e}")
+        except RecursionError:
+            print("Error: Expression nested too deeply")
         except EOFError:
             print("\nExiting...")
             break
@@ -1,10 +1,13 @@
 import subprocess
 import argparse
+import time
+from typing import Optional
 
 INTERPRETER_CONFIG = {
     "python": {
         "compile_command": None,
-        "run_command": "uv run ./ss_py/scheme.py"
+        "run_command": "uv run ./ss_py/scheme.py",
+        "serve_command": "uv run ./ss_py/scheme.py --serve"
     },
     "c": {
         "compile_command": "make -f ./ss_c/Makefile",
@@ -26,6 +29,14 @@ TEST_CONFIG = {
     "conditional": "tests/conditional.ss",
     "lambda": "tests/lambda.ss",
     "recursion": "tests/recursion.ss",
+    "deep_nesting": "tests/deep_nesting.ss",
+    "deep_recursion": "tests/deep_recursion.ss",
+}
+
+# Slow programs checked and timed only with --bench, one process each.
+# `SCHEME_JIT=1 python test_runner.py --bench` times the Python JIT.
+BENCHMARK_CONFIG = {
+    "fib_bench": "tests/fib_bench.ss",
 }
 
 
@@ -58,6 +69,66 @@ def is_float(value: str) -> bool:
         return False
 
 
+END_MARKER = "---END---"
+
+
+def run_batch(serve_command: str, test_files: list[str]) -> list[tuple[int, str, str]]:
+    """Run all test files in one interpreter process.
+
+    Returns (status, stdout, stderr) for each file, in order, where status
+    is what running the file on its own would have exited with.
+    """
+    process = subprocess.Popen(serve_command, shell=True, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    stdout, stderr = process.communicate("".join(f"{test_file}\n" for test_file in test_files))
+
+    results = []
+    errors = stderr.split(END_MARKER + "\n")
+    lines: list[str] = []
+    for line in stdout.splitlines(keepends=True):
+        if line.startswith(END_MARKER):
+            status = int(line[len(END_MARKER):])
+            results.append((status, "".join(lines), errors[len(results)]))
+            lines = []
+        else:
+            lines.append(line)
+    # Files the process never finished, if it died part way.
+    for _ in test_files[len(results):]:
+        results.append((process.returncode or 1, "".join(lines), errors[-1]))
+        lines = []
+    return results
+
+
+def report(test_name: str, tests: list[TestCase], returncode: int, stdout: str, stderr: str) -> None:
+    if returncode != 0:
+        print(f"{RED}Test {test_name} failed: {stderr}{NC}")
+        return
+
+    mismatch = find_mismatch(tests, stdout.strip())
+    if mismatch is not None:
+        test, expected, actual = mismatch
+        print(f"{RED}Test {test_name} failed on expression: {test.expression}{NC}")
+        print(f"  Expected: {expected}, Actual: {actual}\n")
+    else:
+        print(f"{GREEN}Test {test_name} passed{NC}")
+
+
+def find_mismatch(tests: list[TestCase], output: str) -> Optional[tuple[TestCase, object, object]]:
+    """Return the first test whose line of `output` is wrong, with both values."""
+    lines = output.splitlines()
+    for i, test in enumerate(tests):
+        expected = test.expected
+        actual = lines[i] if i < len(lines) else ""
+
+        if is_float(expected) and is_float(actual):
+            expected = float(expected)
+            actual = float(actual)
+
+        if expected != actual:
+            return test, expected, actual
+    return None
+
+
 RED='\033[0;31m'
 GREEN='\033[0;32m'
 NC='\033[0m'
@@ -65,33 +136,35 @@ NC='\033[0m'
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run tests for Scheme interpreter")
     parser.add_argument("-i", "--interpreter", choices=["python", "c", "typescript", "go"], default="python", help="Interpreter to use")
+    parser.add_argument("--bench", action="store_true", help="Also run and time the benchmarks")
     args = parser.parse_args()
     
     config = INTERPRETER_CONFIG[args.interpreter]
     if config["compile_command"]:
         subprocess.run(config["compile_command"], shell=True, check=True)
     
-    for test_name, test_file in TEST_CONFIG.items():
+    batch_results = None
+    if config.get("serve_command"):
+        print(f"Run command: {config['serve_command']}")
+        batch_results = run_batch(config["serve_command"], list(TEST_CONFIG.values()))
+
+    for index, (test_name, test_file) in enumerate(TEST_CONFIG.items()):
         print(f"Running test: {test_name}")
         tests = load_tests_from_file(test_file)
-        print(f"Run command: {config['run_command']} {test_file}")
-        result = subprocess.run(f"{config['run_command']} {test_file}", shell=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"{RED}Test {test_name} failed: {result.stderr}{NC}")
-            continue
-        
-        output = result.stdout.strip()
-        for i, test in enumerate(tests):
-            expected = test.expected
-            actual = output.splitlines()[i]
-            
-            if is_float(expected) and is_float(actual):
-                expected = float(expected)
-                actual = float(actual)
-                
-            if expected != actual:
-                print(f"{RED}Test {test_name} failed on expression: {test.expression}{NC}")
-                print(f"  Expected: {expected}, Actual: {actual}\n")
-                break
+        if batch_results is not None:
+            returncode, stdout, stderr = batch_results[index]
         else:
-            print(f"{GREEN}Test {test_name} passed{NC}")
\ No newline at end of file
+            print(f"Run command: {config['run_command']} {test_file}")
+            result = subprocess.run(f"{config['run_command']} {test_file}", shell=True, capture_output=True, text=True)
+            returncode, stdout, stderr = result.returncode, result.stdout, result.stderr
+        report(test_name, tests, returncode, stdout, stderr)
+
+    if args.bench:
+        for test_name, test_file in BENCHMARK_CONFIG.items():
+            print(f"Running benchmark: {test_name}")
+            tests = load_tests_from_file(test_file)
+            print(f"Run command: {config['run_command']} {test_file}")
+            start = time.perf_counter()
+            result = subprocess.run(f"{config['run_command']} {test_file}", shell=True, capture_output=True, text=True)
+            print(f"Took {time.perf_counter() - start:.2f} s")
+            report(test_name, tests, result.returncode, result.stdout, result.stderr)
\ No newline at end of file